@@ -3,19 +3,76 @@ import requests
 import logging
 import time
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+def _build_session(headers=None):
+    """
+    Creates a requests Session with a pooled, retrying adapter so repeated
+    calls to the same server reuse the TCP/TLS connection.
+    """
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+
+    # Transient failures (connect errors, read timeouts, 429/5xx) are retried with
+    # exponential backoff (0.5s, 1s, 2s, 4s...). PATCH is not retried by default,
+    # but progress updates are idempotent so it is safe to include it.
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods={"GET", "PUT", "PATCH"},
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 class ABSClient:
     def __init__(self):
         self.base_url = os.environ.get("ABS_SERVER", "").rstrip('/')
         self.token = os.environ.get("ABS_KEY")
         self.headers = {"Authorization": f"Bearer {self.token}"}
+        self.session = _build_session(self.headers)
+        # url -> (fetched_at, parsed_json, etag)
+        self._cache = {}
+
+    def _cached_get(self, url, ttl):
+        """
+        GETs a JSON resource, serving it from memory while it is younger than ttl seconds.
+        Stale entries are revalidated with If-None-Match when the server sent an ETag.
+        Returns the parsed JSON, or None if the request did not succeed.
+        """
+        now = time.monotonic()
+        cached = self._cache.get(url)
+        if cached and now - cached[0] < ttl:
+            return cached[1]
+
+        headers = {}
+        if cached and cached[2]:
+            headers['If-None-Match'] = cached[2]
+
+        r = self.session.get(url, headers=headers)
+        if r.status_code == 304 and cached:
+            self._cache[url] = (now, cached[1], cached[2])
+            return cached[1]
+        if r.status_code != 200:
+            logger.error(f"Request to {url} failed: {r.status_code} - {r.text}")
+            return None
+
+        data = r.json()
+        self._cache[url] = (now, data, r.headers.get('ETag'))
+        return data
 
     def check_connection(self):
         url = f"{self.base_url}/api/me"
         try:
-            r = requests.get(url, headers=self.headers, timeout=5)
+            r = self.session.get(url, timeout=5)
             if r.status_code == 200:
                 logger.info(f"✅ Connected to Audiobookshelf as user: {r.json().get('username', 'Unknown')}")
                 return True
@@ -32,25 +89,23 @@ class ABSClient:
     def get_all_audiobooks(self):
         lib_url = f"{self.base_url}/api/libraries"
         try:
-            r = requests.get(lib_url, headers=self.headers)
-            if r.status_code != 200:
-                logger.error(f"Failed to fetch libraries: {r.status_code} - {r.text}")
+            data = self._cached_get(lib_url, ttl=300)
+            if data is None:
+                logger.error("Failed to fetch libraries")
                 return []
             
-            libraries = r.json().get('libraries', [])
+            libraries = data.get('libraries', [])
             all_audiobooks = []
 
-            for lib in libraries:
-                logger.info(f"Scanning library: {lib['name']}...")
-                lib_id = lib['id']
-                items_url = f"{self.base_url}/api/libraries/{lib_id}/items"
-                params = {"mediaType": "audiobook"}
-                r_items = requests.get(items_url, headers=self.headers, params=params)
-                if r_items.status_code == 200:
-                    results = r_items.json().get('results', [])
+            # Libraries are independent, so fetch them concurrently over the pooled session.
+            # Results are collected in library order to keep the listing stable.
+            max_workers = max(1, min(8, len(libraries)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for lib, results in zip(libraries, executor.map(self._get_library_items, libraries)):
+                    if results is None:
+                        logger.warning(f"Could not fetch items for library {lib['name']}")
+                        continue
                     all_audiobooks.extend(results)
-                else:
-                    logger.warning(f"Could not fetch items for library {lib['name']}")
 
             logger.info(f"Found {len(all_audiobooks)} audiobooks across {len(libraries)} libraries.")
             return all_audiobooks
@@ -59,12 +114,26 @@ class ABSClient:
             logger.error(f"Exception fetching audiobooks: {e}")
             return []
 
+    def _get_library_items(self, lib):
+        logger.info(f"Scanning library: {lib['name']}...")
+        items_url = f"{self.base_url}/api/libraries/{lib['id']}/items"
+        params = {"mediaType": "audiobook"}
+        r_items = self.session.get(items_url, params=params)
+        if r_items.status_code == 200:
+            return r_items.json().get('results', [])
+        return None
+
+    def _get_item(self, item_id):
+        """
+        Item JSON shared by get_audio_files/get_ebook_file/download_ebook_file,
+        so back-to-back calls for the same item cost a single request.
+        """
+        return self._cached_get(f"{self.base_url}/api/items/{item_id}", ttl=60)
+
     def get_audio_files(self, item_id):
-        url = f"{self.base_url}/api/items/{item_id}"
         try:
-            r = requests.get(url, headers=self.headers)
-            if r.status_code == 200:
-                data = r.json()
+            data = self._get_item(item_id)
+            if data is not None:
                 files = []
                 audio_files = data.get('media', {}).get('audioFiles', [])
                 for af in audio_files:
@@ -81,7 +150,7 @@ class ABSClient:
                      })
                 return files
             else:
-                logger.error(f"Failed to get audio files for {item_id}: {r.status_code} - {r.text}")
+                logger.error(f"Failed to get audio files for {item_id}")
                 return []
         except Exception as e:
             logger.error(f"Error getting audio files: {e}")
@@ -92,11 +161,9 @@ class ABSClient:
         Fetches the ebook file info and downloads it if present.
         Returns dict with ebook info or None if not available.
         """
-        url = f"{self.base_url}/api/items/{item_id}"
         try:
-            r = requests.get(url, headers=self.headers)
-            if r.status_code == 200:
-                data = r.json()
+            data = self._get_item(item_id)
+            if data is not None:
                 ebook_file = data.get('media', {}).get('ebookFile')
 
                 if ebook_file:
@@ -136,10 +203,10 @@ class ABSClient:
         # Download the file
         try:
             logger.info(f"Downloading ebook: {ebook_info['filename']}")
-            with requests.get(ebook_info['download_url'], stream=True, timeout=120) as r:
+            with self.session.get(ebook_info['download_url'], stream=True, timeout=120) as r:
                 r.raise_for_status()
                 with open(target_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
+                    for chunk in r.iter_content(chunk_size=1 << 20):
                         f.write(chunk)
 
             logger.info(f"✅ Ebook downloaded to: {target_path}")
@@ -151,7 +218,7 @@ class ABSClient:
     def get_progress(self, item_id):
         url = f"{self.base_url}/api/me/progress/{item_id}"
         try:
-            r = requests.get(url, headers=self.headers)
+            r = self.session.get(url)
             if r.status_code == 200:
                 return r.json().get('currentTime', 0)
         except Exception:
@@ -166,7 +233,7 @@ class ABSClient:
             "isFinished": False
         }
         try:
-            requests.patch(url, headers=self.headers, json=payload)
+            self.session.patch(url, json=payload)
         except Exception as e:
             logger.error(f"  Failed to update ABS progress: {e}")
 
@@ -176,20 +243,25 @@ class KoSyncClient:
         self.user = os.environ.get("KOSYNC_USER")
         self.auth_token = hashlib.md5(os.environ.get("KOSYNC_KEY", "").encode('utf-8')).hexdigest()
 
+        # Auth headers are identical for every call, so set them on the session once
+        self.headers = {"x-auth-user": self.user, "x-auth-key": self.auth_token, "accept": "application/vnd.koreader.v1+json"}
+        self.session = _build_session(self.headers)
+        # doc_id -> (percentage, xpath), sent by flush_progress()
+        self._pending = {}
+
         logger.debug(f"KOSYNC_USER: {self.user}")
         logger.debug(f"KOSYNC_KEY: {self.auth_token}")
 
     def check_connection(self):
         url = f"{self.base_url}/healthcheck"
-        headers = {"x-auth-user": self.user, "x-auth-key": self.auth_token, "accept": "application/vnd.koreader.v1+json"}
         try:
-            r = requests.get(url, timeout=5)
+            r = self.session.get(url, timeout=5)
             if r.status_code == 200:
                  logger.info(f"✅ Connected to KoSync Server at {self.base_url}")
                  return True
             
             url_sync = f"{self.base_url}/syncs/progress/test-connection"
-            r = requests.get(url_sync, headers=headers, timeout=5)
+            r = self.session.get(url_sync, timeout=5)
             logger.info(f"✅ Connected to KoSync Server (Response: {r.status_code})")
             return True
         except requests.exceptions.ConnectionError:
@@ -200,11 +272,10 @@ class KoSyncClient:
             return False
 
     def get_progress(self, doc_id):
-        headers = {"x-auth-user": self.user, "x-auth-key": self.auth_token, 'accept': 'application/vnd.koreader.v1+json'}
         logger.info(f" Getting KoSync progress for doc_id: {doc_id}")
         url = f"{self.base_url}/syncs/progress/{doc_id}"
         try:
-            r = requests.get(url, headers=headers)
+            r = self.session.get(url)
             if r.status_code == 200:
                 data = r.json()
                 logger.debug(f" Progress: {data}")
@@ -214,7 +285,6 @@ class KoSyncClient:
         return 0.0
 
     def update_progress(self, doc_id, percentage, xpath=None):
-        headers = {"x-auth-user": self.user, "x-auth-key": self.auth_token, 'accept': 'application/vnd.koreader.v1+json', 'content-type': 'application/json'}
         url = f"{self.base_url}/syncs/progress"
         logger.info(f" Updating KoSync progress for doc_id: {doc_id}")
         
@@ -234,7 +304,7 @@ class KoSyncClient:
         
         try:
             # Reverted to simple PUT logic
-            r = requests.put(url, headers=headers, json=payload)
+            r = self.session.put(url, json=payload)
             
             if r.status_code not in [200, 201]:
                 logger.error(f"  KoSync Update Failed: {r.status_code} - {r.text}")
@@ -243,3 +313,19 @@ class KoSyncClient:
                 
         except Exception as e:
             logger.error(f"Failed to update KoSync: {e}")
+
+    def queue_progress(self, doc_id, percentage, xpath=None):
+        """
+        Queues a progress update to be sent by flush_progress().
+        A later update for the same doc_id replaces the earlier one (last write wins).
+        """
+        self._pending[doc_id] = (percentage, xpath)
+
+    def flush_progress(self):
+        """
+        Sends all queued updates back-to-back over the keep-alive session.
+        KoSync has no bulk endpoint, so each document is still its own PUT.
+        """
+        pending, self._pending = self._pending, {}
+        for doc_id, (percentage, xpath) in pending.items():
+            self.update_progress(doc_id, percentage, xpath)
@@ -1,50 +1,122 @@
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup, NavigableString, Tag
+from lxml import etree
 import hashlib
 import logging
 import os
-import re
-import glob # <--- Added import for escaping
+import pickle
+import posixpath
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import rapidfuzz
 from pathlib import Path
+from urllib.parse import unquote
 from rapidfuzz import process, fuzz
 from fuzzysearch import find_near_matches
 
 logger = logging.getLogger(__name__)
 
+# Bump when extracted text or the on-disk cache layout changes
+PARSE_CACHE_VERSION = 4
+
+_CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+_OPF_NS = "http://www.idpf.org/2007/opf"
+
+# Sample offsets of KOReader's fastDigest: 0, then 1024 << 2*i for i in 0..10
+_KOREADER_OFFSETS = (0,) + tuple(1024 << (2 * i) for i in range(11))
+
+# Every ASCII byte except a-z and 0-9, deleted by _normalize
+_NON_ALNUM_BYTES = bytes(c for c in range(128) if not (chr(c).isdigit() or 'a' <= chr(c) <= 'z'))
+
+# lxml parsers must not be shared between threads, and spine items are parsed concurrently
+_parsers = threading.local()
+
+def _parse_html(html_content):
+    """
+    Parses a spine item's raw bytes. EPUB content documents are UTF-8 unless they
+    say otherwise, but libxml2's HTML parser falls back to Latin-1. So UTF-8 is
+    forced unless there is a BOM, an XML declaration or a charset declaration.
+    """
+    head = html_content[:2048].lstrip()
+    declared = (
+        head.startswith((b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff', b'<?xml'))
+        or b'charset' in head.lower()
+    )
+    if declared:
+        return etree.HTML(html_content)
+    parser = getattr(_parsers, 'utf8', None)
+    if parser is None:
+        parser = _parsers.utf8 = etree.HTMLParser(encoding='utf-8')
+    return etree.HTML(html_content, parser=parser)
+
+def _html_body(html_content):
+    """
+    Parses a spine item and returns its <body> (or the root if there is none).
+    Only the body is rendered by KOReader, so <head> text such as <title> is ignored.
+    """
+    root = _parse_html(html_content)
+    if root is None:
+        return None
+    body = root.find('body')
+    return body if body is not None else root
+
+def _html_to_text(html_content):
+    """
+    Plain text of a spine item's body, equivalent to BeautifulSoup's
+    get_text(separator=' ', strip=True) (script/style/template are skipped).
+    """
+    body = _html_body(html_content)
+    if body is None:
+        return ""
+    etree.strip_elements(body, 'script', 'style', 'template', with_tail=False)
+    return " ".join(s.strip() for s in body.itertext() if s.strip())
+
 class EbookParser:
-    def __init__(self, books_dir):
+    def __init__(self, books_dir, cache_dir=None):
         self.books_dir = books_dir
-        self.cache = {} 
-        self.normalized_cache = {}
+        # Parsed ebooks are persisted here so restarts don't re-parse every EPUB
+        self.cache_dir = Path(cache_dir) if cache_dir else Path(books_dir) / ".cache"
+        # Book path -> {"text", "spine_map", "normalized"}, least recently used first.
+        # spine_map stores where chapters begin/end in the full text.
+        # Bounded because the disk cache makes reloading an evicted book cheap.
+        self.cache = OrderedDict()
+        self.max_cached_books = max(1, int(os.getenv("EBOOK_CACHE_MAX_BOOKS", 8)))
         self.sentence_cache = {}
-        # Stores metadata about where chapters begin/end in the full text
-        self.spine_maps = {} 
+        # filename -> Path, built lazily by _resolve_book_path
+        self._name_index = None
         
         self.fuzzy_threshold = int(os.getenv("FUZZY_MATCH_THRESHOLD", 80))
         self.hash_method = os.getenv("KOSYNC_HASH_METHOD", "content").lower()
         logger.info(f"Initialized EbookParser. ID Method: {self.hash_method}")
 
+    def _build_name_index(self):
+        """
+        Walks the books directory once and maps each filename to its path.
+        os.walk is scandir based, so no Path objects are built for directories.
+        """
+        index = {}
+        for root, _dirs, files in os.walk(self.books_dir):
+            for name in files:
+                # Keep the first hit if a filename appears more than once
+                index.setdefault(name, Path(root) / name)
+        self._name_index = index
+
     def _resolve_book_path(self, filename):
         """
-        Robustly finds a file in the books directory, handling special characters
-        like [ ] (brackets) which break standard glob patterns.
+        Finds a file in the books directory via a filename index. Plain dict lookups
+        also avoid glob's trouble with special characters like [ ] (brackets).
+        The index is rebuilt on a miss so newly added books are picked up.
         """
-        # 1. Try Glob with escaping (Fastest)
-        try:
-            # Escape brackets, etc.
-            safe_name = glob.escape(filename) 
-            return next(self.books_dir.glob(f"**/{safe_name}"))
-        except StopIteration:
-            pass
-            
-        # 2. Fallback: Linear scan (Slower, but 100% reliable)
-        # This catches edge cases where glob.escape might behave differently on OS versions
-        for f in self.books_dir.rglob("*"):
-            if f.name == filename:
-                return f
-        
+        if self._name_index is not None:
+            path = self._name_index.get(filename)
+            if path is not None and path.exists():
+                return path
+
+        self._build_name_index()
+        path = self._name_index.get(filename)
+        if path is not None:
+            return path
+
         raise FileNotFoundError(f"Could not locate {filename}")
 
     def get_kosync_id(self, filepath):
@@ -59,11 +131,10 @@ class EbookParser:
     def _compute_koreader_hash(self, filepath):
         md5 = hashlib.md5()
         try:
-            file_size = os.path.getsize(filepath)
-            with open(filepath, 'rb') as f:
-                for i in range(-1, 11): 
-                    if i == -1: offset = 0
-                    else: offset = 1024 * (4 ** i)
+            # Unbuffered: each sample is a single 1 KiB read instead of a full buffer fill
+            with open(filepath, 'rb', buffering=0) as f:
+                file_size = os.fstat(f.fileno()).st_size
+                for offset in _KOREADER_OFFSETS:
                     if offset >= file_size: break
                     f.seek(offset)
                     chunk = f.read(1024)
@@ -74,42 +145,121 @@ class EbookParser:
             logger.error(f"Error computing hash: {e}")
             return None
 
+    def _load_parse_cache(self, cache_path, filepath):
+        try:
+            if not cache_path.exists() or cache_path.stat().st_mtime < filepath.stat().st_mtime:
+                return None
+            with open(cache_path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') != PARSE_CACHE_VERSION:
+                return None
+            return data
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable ebook cache {cache_path.name}: {e}")
+            return None
+
+    def _save_parse_cache(self, cache_path, data):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, protocol=5)
+            # Atomic swap so a crash mid-write never leaves a truncated cache behind
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.warning(f"Could not write ebook cache {cache_path.name}: {e}")
+
+    def _get_cached_book(self, filepath):
+        entry = self.cache.get(str(filepath))
+        if entry:
+            self.cache.move_to_end(str(filepath))
+        return entry
+
+    def _cache_book(self, filepath, entry):
+        self.cache[str(filepath)] = entry
+        self.cache.move_to_end(str(filepath))
+        while len(self.cache) > self.max_cached_books:
+            evicted, _ = self.cache.popitem(last=False)
+            logger.debug(f"Evicted ebook from memory cache: {evicted}")
+
+    def _read_spine(self, zf):
+        """
+        Returns [(spine position, zip path)] for the XHTML documents of an EPUB,
+        read straight from container.xml and the OPF without loading any other item.
+        """
+        container = etree.fromstring(zf.read("META-INF/container.xml"))
+        opf_path = container.find(f".//{{{_CONTAINER_NS}}}rootfile").get("full-path")
+        opf = etree.fromstring(zf.read(opf_path))
+        opf_dir = posixpath.dirname(opf_path)
+
+        manifest = {item.get("id"): item for item in opf.iterfind(f"{{{_OPF_NS}}}manifest/{{{_OPF_NS}}}item")}
+
+        documents = []
+        for i, itemref in enumerate(opf.iterfind(f"{{{_OPF_NS}}}spine/{{{_OPF_NS}}}itemref")):
+            item = manifest.get(itemref.get("idref"))
+            if item is None or item.get("media-type") != "application/xhtml+xml":
+                continue
+            href = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get("href"))))
+            documents.append((i, href))
+        return documents
+
     def extract_text_and_map(self, filepath):
         filepath = Path(filepath)
-        if str(filepath) in self.cache:
-            return self.cache[str(filepath)], self.spine_maps[str(filepath)]
+        entry = self._get_cached_book(filepath)
+        if entry:
+            return entry['text'], entry['spine_map']
+
+        book_hash = self._compute_koreader_hash(filepath)
+        cache_path = self.cache_dir / f"{book_hash}.pkl" if book_hash else None
+        if cache_path:
+            cached = self._load_parse_cache(cache_path, filepath)
+            if cached:
+                logger.info(f"Loaded ebook structure from cache: {filepath.name}")
+                self._cache_book(filepath, cached)
+                return cached['text'], cached['spine_map']
 
         logger.info(f"Parsing ebook structure: {filepath.name}")
         try:
-            book = epub.read_epub(str(filepath))
             full_text_parts = []
             spine_map = [] 
             
+            # Read the documents serially (cheap), then extract their text in parallel.
+            # lxml releases the GIL while parsing, so chapters parse concurrently.
+            with zipfile.ZipFile(filepath) as zf:
+                documents = [(i, href, zf.read(href)) for i, href in self._read_spine(zf)]
+
+            max_workers = max(1, min(os.cpu_count() or 1, len(documents)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                texts = list(executor.map(_html_to_text, [content for _, _, content in documents]))
+
             current_idx = 0
             
-            for i, item_ref in enumerate(book.spine):
-                item = book.get_item_with_id(item_ref[0])
-                if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                    soup = BeautifulSoup(item.get_content(), 'html.parser')
-                    text = soup.get_text(separator=' ', strip=True)
-                    
-                    start = current_idx
-                    length = len(text)
-                    end = current_idx + length
-                    
-                    spine_map.append({
-                        "start": start,
-                        "end": end,
-                        "spine_index": i + 1, 
-                        "content": item.get_content() 
-                    })
-                    
-                    full_text_parts.append(text)
-                    current_idx = end + 1 
+            for (i, href, _), text in zip(documents, texts):
+                start = current_idx
+                length = len(text)
+                end = current_idx + length
+                
+                spine_map.append({
+                    "start": start,
+                    "end": end,
+                    "spine_index": i + 1, 
+                    # Chapter HTML is re-read from the EPUB only when an XPath is needed
+                    "href": href
+                })
+                
+                full_text_parts.append(text)
+                current_idx = end + 1 
             
             combined_text = " ".join(full_text_parts)
-            self.cache[str(filepath)] = combined_text
-            self.spine_maps[str(filepath)] = spine_map
+            entry = {
+                "text": combined_text,
+                "spine_map": spine_map,
+                "normalized": self._normalize(combined_text)
+            }
+            self._cache_book(filepath, entry)
+
+            if cache_path:
+                self._save_parse_cache(cache_path, {"version": PARSE_CACHE_VERSION, **entry})
             
             return combined_text, spine_map
             
@@ -118,48 +268,86 @@ class EbookParser:
             return "", []
 
     def _generate_xpath(self, html_content, local_target_index):
-        soup = BeautifulSoup(html_content, 'html.parser')
+        body = _html_body(html_content)
+        if body is None:
+            return "/body/div/p[1]"
+
         current_char_count = 0
         target_tag = None
-        
-        elements = soup.find_all(string=True)
-        for string in elements:
+
+        # Text nodes in document order. A tail string belongs to the element's parent.
+        for string in body.xpath('.//text()'):
             text_len = len(string.strip())
             if text_len == 0: continue
-            
+
             if current_char_count + text_len >= local_target_index:
-                target_tag = string.parent
+                target_tag = string.getparent()
+                if string.is_tail:
+                    target_tag = target_tag.getparent()
                 break
-            
+
             current_char_count += text_len
             if current_char_count < local_target_index:
                 current_char_count += 1
-        
-        if not target_tag:
+
+        if target_tag is None:
             return "/body/div/p[1]"
 
         path_segments = []
         curr = target_tag
-        while curr and curr.name != '[document]':
-            if curr.name == 'body':
+        while curr is not None:
+            if curr.tag == 'body':
                 path_segments.append("body")
                 break
-            
-            index = 1
-            sibling = curr.previous_sibling
-            while sibling:
-                if isinstance(sibling, Tag) and sibling.name == curr.name:
-                    index += 1
-                sibling = sibling.previous_sibling
-            
-            segment = f"{curr.name}[{index}]"
-            path_segments.append(segment)
-            curr = curr.parent
-            
+
+            # itersiblings(tag=...) filters in C, no Python walk over every sibling
+            index = 1 + sum(1 for _ in curr.itersiblings(curr.tag, preceding=True))
+            path_segments.append(f"{curr.tag}[{index}]")
+            curr = curr.getparent()
+
         return "/" + "/".join(reversed(path_segments))
 
     def _normalize(self, text):
-        return re.sub(r'[^a-z0-9]', '', text.lower())
+        # Equivalent to re.sub(r'[^a-z0-9]', '', text.lower()), but both steps run as
+        # single C passes: non-ASCII is dropped on encode, the rest by bytes.translate.
+        return text.lower().encode('ascii', 'ignore').translate(None, _NON_ALNUM_BYTES).decode('ascii')
+
+    def _fuzzy_align(self, search_phrase, full_text, score_cutoff):
+        """
+        Fuzzy-aligns search_phrase within full_text. Returns (score, start index),
+        or (0, -1) if nothing reaches score_cutoff.
+
+        If the first or last 40 characters of the phrase occur verbatim, only a
+        ±1 KiB window around that hit is scored. The whole book is scanned only
+        when neither anchor helps.
+        """
+        anchor_len = 40
+        margin = 1024
+
+        if len(search_phrase) > anchor_len:
+            anchors = (
+                (search_phrase[:anchor_len], 0),
+                (search_phrase[-anchor_len:], len(search_phrase) - anchor_len)
+            )
+            for anchor, offset_in_phrase in anchors:
+                hit = full_text.find(anchor)
+                if hit == -1: continue
+
+                phrase_start = hit - offset_in_phrase
+                window_start = max(0, phrase_start - margin)
+                window = full_text[window_start:phrase_start + len(search_phrase) + margin]
+                alignment = rapidfuzz.fuzz.partial_ratio_alignment(search_phrase, window, score_cutoff=score_cutoff)
+                if alignment:
+                    return alignment.score, window_start + alignment.dest_start
+
+        # partial_ratio_alignment finds the best alignment of the search_phrase 
+        # within the full_text.
+        # Returns an object with: score, src_start, src_end, dest_start, dest_end
+        alignment = rapidfuzz.fuzz.partial_ratio_alignment(search_phrase, full_text, score_cutoff=score_cutoff)
+        if alignment:
+            # 'dest_start' is the index where the match starts in full_text
+            return alignment.score, alignment.dest_start
+        return 0, -1
 
     def find_text_location(self, filename, search_phrase):
         try:
@@ -168,7 +356,14 @@ class EbookParser:
             
             full_text, spine_map = self.extract_text_and_map(book_path)
             
-            if not full_text: return None, None
+            if not full_text: return None, None, None
+
+            # Each pass below is a single C-level substring scan. Bail out early on
+            # phrases with nothing to search for, which would otherwise "match" at index 0.
+            norm_search = self._normalize(search_phrase)
+            if not norm_search:
+                logger.warning("  Search phrase has no searchable characters. Skipping.")
+                return None, None, None
 
             total_len = len(full_text)
             match_index = -1
@@ -179,12 +374,7 @@ class EbookParser:
             # 2. Normalized Match
             if match_index == -1:
                 logger.info("  ...Exact match failed. Trying Normalized match...")
-                cache_key = str(filename)
-                if cache_key not in self.normalized_cache:
-                    self.normalized_cache[cache_key] = self._normalize(full_text)
-                
-                norm_content = self.normalized_cache[cache_key]
-                norm_search = self._normalize(search_phrase)
+                norm_content = self._get_cached_book(book_path)['normalized']
                 norm_index = norm_content.find(norm_search)
 
                 if norm_index != -1:
@@ -230,19 +420,10 @@ class EbookParser:
                 # ~75 is roughly equivalent to allowing 20-25% errors.
                 cutoff_score = 75 
 
-                # partial_ratio_alignment finds the best alignment of the search_phrase 
-                # within the full_text.
-                # Returns an object with: score, src_start, src_end, dest_start, dest_end
-                alignment = rapidfuzz.fuzz.partial_ratio_alignment(
-                    search_phrase, 
-                    full_text, 
-                    score_cutoff=cutoff_score
-                )
-
-                if alignment:
-                    logger.info(f"  ✅ Fuzzy match successful (Score: {alignment.score:.1f}).")
-                    # 'dest_start' is the index where the match starts in full_text
-                    match_index = alignment.dest_start
+                score, fuzzy_index = self._fuzzy_align(search_phrase, full_text, cutoff_score)
+                if fuzzy_index != -1:
+                    logger.info(f"  ✅ Fuzzy match successful (Score: {score:.1f}).")
+                    match_index = fuzzy_index
             
             if match_index != -1:
                 percentage = match_index / total_len
@@ -250,7 +431,9 @@ class EbookParser:
                 for item in spine_map:
                     if item['start'] <= match_index < item['end']:
                         local_index = match_index - item['start']
-                        dom_path = self._generate_xpath(item['content'], local_index)
+                        with zipfile.ZipFile(book_path) as zf:
+                            html_content = zf.read(item['href'])
+                        dom_path = self._generate_xpath(html_content, local_index)
                         xpath = f"/body/DocFragment[{item['spine_index']}]{dom_path}"
                         logger.info(f"  📍 Generated XPath: {xpath}")
                         break
@@ -1,9 +1,11 @@
 import os
 import time
-import json
+import orjson
 import schedule
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
 from pathlib import Path
 from rapidfuzz import process, fuzz
 
@@ -43,6 +45,18 @@ DATA_DIR = Path("/data")
 BOOKS_DIR = Path("/books")
 DB_FILE = DATA_DIR / "mapping_db.json"
 STATE_FILE = DATA_DIR / "last_state.json"
+# Most titles the matching wizard lists at once
+WIZARD_LIST_LIMIT = 20
+
+@dataclass(slots=True)
+class SyncState:
+    """Last synced positions of one mapping, keyed by abs_id in last_state.json."""
+    abs_ts: float = 0
+    kosync_pct: float = 0
+    kosync_index: int = 0
+    last_updated: float = 0
+
+_SYNC_STATE_FIELDS = frozenset(f.name for f in fields(SyncState))
 
 class SyncManager:
     def __init__(self):
@@ -50,9 +64,13 @@ class SyncManager:
         self.abs_client = ABSClient()
         self.kosync_client = KoSyncClient()
         self.transcriber = AudioTranscriber(DATA_DIR)
-        self.ebook_parser = EbookParser(BOOKS_DIR)
+        self.ebook_parser = EbookParser(BOOKS_DIR, DATA_DIR / "ebook_cache")
+        # mtime of the mapping DB when it was last read or written, to skip re-parsing an unchanged file
+        self._db_mtime = None
         self.db = self._load_db()
         self.state = self._load_state()
+        # Set when self.state changes; flushed to disk once at the end of sync_cycle
+        self._state_dirty = False
         
         # Load Sync Thresholds
         # ABS: Seconds (Default 60s)
@@ -88,19 +106,33 @@ class SyncManager:
 
     def _load_db(self):
         if DB_FILE.exists():
-            with open(DB_FILE, 'r') as f: return json.load(f)
+            mtime = DB_FILE.stat().st_mtime_ns
+            if mtime == self._db_mtime:
+                return self.db
+            db = orjson.loads(DB_FILE.read_bytes())
+            self._db_mtime = mtime
+            return db
+        self._db_mtime = None
         return {"mappings": []}
 
     def _save_db(self):
-        with open(DB_FILE, 'w') as f: json.dump(self.db, f, indent=4)
+        # Kept indented, people read and hand-edit the mapping DB
+        DB_FILE.write_bytes(orjson.dumps(self.db, option=orjson.OPT_INDENT_2))
+        self._db_mtime = DB_FILE.stat().st_mtime_ns
 
     def _load_state(self):
         if STATE_FILE.exists():
-            with open(STATE_FILE, 'r') as f: return json.load(f)
+            raw = orjson.loads(STATE_FILE.read_bytes())
+            # Unknown keys from older or newer versions are dropped, missing ones take defaults
+            return {
+                abs_id: SyncState(**{k: v for k, v in entry.items() if k in _SYNC_STATE_FIELDS})
+                for abs_id, entry in raw.items()
+            }
         return {}
 
     def _save_state(self):
-        with open(STATE_FILE, 'w') as f: json.dump(self.state, f, indent=4)
+        # Rewritten on every sync, so stored compact. orjson serializes the SyncState dataclasses directly.
+        STATE_FILE.write_bytes(orjson.dumps(self.state))
 
     def _get_abs_title(self, item):
         title = item.get('media', {}).get('metadata', {}).get('title')
@@ -108,6 +140,46 @@ class SyncManager:
         if not title: title = item.get('title')
         return title or "Unknown Title"
 
+    def _filter_by_title(self, search_term, items, titles_lower, limit=WIZARD_LIST_LIMIT):
+        """
+        Returns up to limit items whose lower-cased title fuzzy-matches search_term,
+        best match first. Substring hits score 100, and the partial_ratio cutoff
+        also tolerates small typos. A blank term returns the first limit items.
+        """
+        if not search_term:
+            return items[:limit]
+        matches = process.extract(
+            search_term, titles_lower, scorer=fuzz.partial_ratio, score_cutoff=70, limit=limit
+        )
+        return [items[idx] for _, _, idx in matches]
+
+    def _choose_from(self, label, items, titles, search_term, describe):
+        """
+        Shows at most WIZARD_LIST_LIMIT ranked matches for search_term and returns
+        the picked item, or None. Typing text instead of a number refines the filter.
+        """
+        titles_lower = [t.lower() for t in titles]
+        while True:
+            shown = self._filter_by_title(search_term, items, titles_lower)
+            if not shown:
+                print(f"❌ No {label.lower()}s found matching term: '{search_term}'")
+                search_term = input("Filter by title (Press Enter to cancel): ").strip().lower()
+                if not search_term: return None
+                continue
+
+            print(f"\n--- Available {label}s ({len(shown)} shown of {len(items)}) ---")
+            for idx, item in enumerate(shown):
+                print(f"{idx + 1}. {describe(item)}")
+            if len(shown) == WIZARD_LIST_LIMIT < len(items):
+                print("(List capped, type part of a title to narrow it)")
+
+            choice = input(f"\nSelect {label} Number (or type to filter again): ").strip()
+            if not choice: return None
+            if choice.isdigit():
+                idx = int(choice) - 1
+                return shown[idx] if 0 <= idx < len(shown) else None
+            search_term = choice.lower()
+
     def match_wizard(self, ebooks_in_abs: bool = False ):
         print("\n=== Matching Wizard (Queue Mode) ===")
         print("Fetching audiobooks from server...")
@@ -132,45 +204,16 @@ class SyncManager:
                 print("❌ No ebooks found in /books.")
                 return
 
-        search_term = input("\nFilter by title (Press Enter to view all): ").strip().lower()
-
-        if search_term:
-            # Filter Audiobooks based on title
-            filtered_audiobooks = [
-                ab for ab in audiobooks
-                if search_term in self._get_abs_title(ab).lower()
-            ]
-
-            if not ebooks_in_abs:
-                # Filter Ebooks based on filename
-                filtered_ebooks = [
-                    eb for eb in ebooks
-                    if search_term in eb.name.lower()
-                ]
-        else:
-            # If blank, keep lists as is
-            filtered_audiobooks = audiobooks
-            if not ebooks_in_abs:
-                filtered_ebooks = ebooks
-
-        if not filtered_audiobooks:
-            print(f"❌ No audiobooks found matching term: '{search_term}'")
-            return
-
-        if not ebooks_in_abs and not filtered_ebooks:
-            print(f"❌ No ebooks found matching term: '{search_term}'")
-            return
+        search_term = input(f"\nFilter by title (Press Enter to list the first {WIZARD_LIST_LIMIT}): ").strip().lower()
 
-        print(f"\n--- Available Audiobooks ({len(filtered_audiobooks)} found) ---")
-        for idx, ab in enumerate(filtered_audiobooks):
-            title = self._get_abs_title(ab)
+        def describe_audiobook(ab):
             ebook_indicator = " [Has Ebook]" if ab.get('media', {}).get('ebookFile') else ""
-            print(f"{idx + 1}. {title}{ebook_indicator} (ID: {ab.get('id')})")
+            return f"{self._get_abs_title(ab)}{ebook_indicator} (ID: {ab.get('id')})"
 
-        try:
-            ab_choice = int(input("\nSelect Audiobook Number: ")) - 1
-            selected_ab = filtered_audiobooks[ab_choice]
-        except (ValueError, IndexError):
+        selected_ab = self._choose_from(
+            "Audiobook", audiobooks, [self._get_abs_title(ab) for ab in audiobooks], search_term, describe_audiobook
+        )
+        if not selected_ab:
             return
 
         if ebooks_in_abs:
@@ -183,14 +226,10 @@ class SyncManager:
             selected_eb = ebook_path
         else:
             # Original flow - select from disk
-            print("\n--- Available Ebooks ---")
-            for idx, eb in enumerate(filtered_ebooks):
-                print(f"{idx + 1}. {eb.name}")
-
-            try:
-                eb_choice = int(input("\nSelect Ebook Number: ")) - 1
-                selected_eb = filtered_ebooks[eb_choice]
-            except (ValueError, IndexError):
+            selected_eb = self._choose_from(
+                "Ebook", ebooks, [eb.name for eb in ebooks], search_term, lambda eb: eb.name
+            )
+            if not selected_eb:
                 return
 
         kosync_doc_id = self.ebook_parser.get_kosync_id(selected_eb)
@@ -214,10 +253,12 @@ class SyncManager:
 
     def check_pending_jobs(self):
         self.db = self._load_db()
+        ran_jobs = False
         for mapping in self.db['mappings']:
             if mapping.get('status') == 'pending':
                 abs_title = mapping.get('abs_title', 'Unknown')
                 logger.info(f"🚀 Found pending job for: {abs_title}")
+                ran_jobs = True
                 
                 mapping['status'] = 'processing'
                 self._save_db()
@@ -246,15 +287,40 @@ class SyncManager:
                     mapping['status'] = 'failed_retry_later' 
                     self._save_db()
 
+        # The Whisper model is shared by every job in this sweep; release it until the next one
+        if ran_jobs:
+            self.transcriber.unload_model()
+
     def sync_cycle(self):
         logger.debug("Starting Sync Cycle...")
         self.db = self._load_db() 
         
         if not self.db['mappings']: return
 
-        for mapping in self.db['mappings']:
-            if mapping.get('status', 'active') != 'active': continue
-                
+        try:
+            self._sync_mappings()
+        finally:
+            # Queued KoSync updates and state changes are written once per cycle
+            self.kosync_client.flush_progress()
+            if self._state_dirty:
+                self._save_state()
+                self._state_dirty = False
+
+    def _sync_mappings(self):
+        active_mappings = [m for m in self.db['mappings'] if m.get('status', 'active') == 'active']
+        if not active_mappings: return
+
+        # Progress lookups are independent round-trips, so fetch them all concurrently up front
+        with ThreadPoolExecutor(max_workers=min(16, 2 * len(active_mappings))) as executor:
+            progress_futures = [
+                (
+                    executor.submit(self.abs_client.get_progress, m['abs_id']),
+                    executor.submit(self.kosync_client.get_progress, m['kosync_doc_id'])
+                )
+                for m in active_mappings
+            ]
+
+        for mapping, (abs_future, kosync_future) in zip(active_mappings, progress_futures):
             abs_id = mapping['abs_id']
             kosync_id = mapping['kosync_doc_id']
             transcript_path = mapping['transcript_file']
@@ -262,21 +328,18 @@ class SyncManager:
             abs_title = mapping.get('abs_title', 'Unknown')
 
             try:
-                abs_progress = self.abs_client.get_progress(abs_id)
-                kosync_progress = self.kosync_client.get_progress(kosync_id)
+                abs_progress = abs_future.result()
+                kosync_progress = kosync_future.result()
             except Exception as e:
                 logger.error(f"Fetch failed for {abs_title}: {e}")
                 continue
 
-            prev_state = self.state.get(abs_id, {"abs_ts": 0, "kosync_pct": 0, "last_updated": 0, "kosync_index": 0})
-
-            ## Define and set defaults if empty.
-            defaults = {"abs_ts": 0, "kosync_pct": 0, "last_updated": 0, "kosync_index": 0}
-            existing_data = self.state.get(abs_id, {})
-            prev_state = defaults | existing_data
+            # Work on a copy; it only replaces the stored state once a branch below commits it
+            existing_state = self.state.get(abs_id)
+            prev_state = replace(existing_state) if existing_state else SyncState()
                 
-            abs_delta = abs(abs_progress - prev_state['abs_ts'])
-            kosync_delta = abs(kosync_progress - prev_state['kosync_pct'])
+            abs_delta = abs(abs_progress - prev_state.abs_ts)
+            kosync_delta = abs(kosync_progress - prev_state.kosync_pct)
             
             # --- THRESHOLD LOGIC ---
             abs_changed = abs_delta > self.delta_abs_thresh
@@ -285,18 +348,18 @@ class SyncManager:
             # Log ignored changes for debugging
             if abs_delta > 0 and not abs_changed:
                 logger.info(f"  ✋ ABS delta {abs_delta:.2f}s (Below threshold {self.delta_abs_thresh}s): {abs_title}")
-                prev_state['abs_ts'] = abs_progress   
-                prev_state['last_updated'] = time.time()
+                prev_state.abs_ts = abs_progress   
+                prev_state.last_updated = time.time()
                 ## change me
-                prev_state['kosync_index'] = 0
+                prev_state.kosync_index = 0
                 self.state[abs_id] = prev_state
-                self._save_state()
+                self._state_dirty = True
                 logger.info("  🤷 State matched to avoid loop.")
             if kosync_delta > 0 and not kosync_changed:
                 logger.info(f"  ✋ KoSync delta {kosync_delta:.4%} (Below threshold {self.delta_kosync_thresh:.2%}): {ebook_filename}")
                 # logger.info(f"  🪲 Attempting to resolve character delta")
                 
-                index_delta = self.ebook_parser.get_character_delta(ebook_filename, prev_state['kosync_pct'], kosync_progress)
+                index_delta = self.ebook_parser.get_character_delta(ebook_filename, prev_state.kosync_pct, kosync_progress)
                 # logger.info(f"  🪲 KoSync character delta {index_delta}")
 
                 ## Hardcoded for testing! Adjust for new env variable.
@@ -305,19 +368,19 @@ class SyncManager:
                     logger.info(f"  🪲 KoSync character delta more than threshhold {index_delta}/{self.delta_kosync_char_thresh}")
                 else:  
                     logger.info(f"  🪲 KoSync character delta less than threshhold {index_delta}/{self.delta_kosync_char_thresh}")
-                    prev_state['kosync_pct'] = kosync_progress
-                    prev_state['last_updated'] = time.time()
+                    prev_state.kosync_pct = kosync_progress
+                    prev_state.last_updated = time.time()
                     ## change me
-                    prev_state['kosync_index'] = 0
+                    prev_state.kosync_index = 0
                     self.state[abs_id] = prev_state
-                    self._save_state()
+                    self._state_dirty = True
                     logger.info("  🤷 State matched to avoid loop.")
 
             if not abs_changed and not kosync_changed: continue
 
             logger.info(f"Change detected for '{abs_title}'")
-            logger.info(f"  📊 ABS: {prev_state['abs_ts']:.2f}s -> {abs_progress:.2f}s")
-            logger.info(f"  📊 KoSync: {prev_state['kosync_pct']:.4f}% -> {kosync_progress:.4f}%")
+            logger.info(f"  📊 ABS: {prev_state.abs_ts:.2f}s -> {abs_progress:.2f}s")
+            logger.info(f"  📊 KoSync: {prev_state.kosync_pct:.4f}% -> {kosync_progress:.4f}%")
             
             source = "ABS" if abs_changed else "KOSYNC"
             if abs_changed and kosync_changed:
@@ -336,14 +399,14 @@ class SyncManager:
                             logger.info(f"  ✅ Match at {matched_pct:.2%}. Sending Update...")
 
                             ## DEBUG. WIP function, to measure change in position based on characters not %
-                            index_delta = abs(matched_index - prev_state['kosync_index'])
+                            index_delta = abs(matched_index - prev_state.kosync_index)
                             #index_delta = abs(matched_index - prev_state.get('kosync_index', 0))
                             logger.info(f"  🪲 Index delta of {index_delta}.")
                             
-                            self.kosync_client.update_progress(kosync_id, matched_pct, xpath)
-                            prev_state['abs_ts'] = abs_progress
-                            prev_state['kosync_pct'] = matched_pct
-                            prev_state['kosync_index'] = index_delta
+                            self.kosync_client.queue_progress(kosync_id, matched_pct, xpath)
+                            prev_state.abs_ts = abs_progress
+                            prev_state.kosync_pct = matched_pct
+                            prev_state.kosync_index = index_delta
                             updated_ok = True
                         else:
                             logger.error("  ❌ Ebook text match FAILED.")
@@ -355,23 +418,23 @@ class SyncManager:
                         if matched_time is not None:
                             logger.info(f"  ✅ Match at {matched_time:.2f}s. Sending Update...")
                             self.abs_client.update_progress(abs_id, matched_time)
-                            prev_state['abs_ts'] = matched_time
-                            prev_state['kosync_pct'] = kosync_progress
+                            prev_state.abs_ts = matched_time
+                            prev_state.kosync_pct = kosync_progress
                             updated_ok = True
                         else:
                              logger.error("  ❌ Transcript text match FAILED.")
 
                 if updated_ok:
-                    prev_state['last_updated'] = time.time()
+                    prev_state.last_updated = time.time()
                     self.state[abs_id] = prev_state
-                    self._save_state()
-                    logger.info("  💾 State saved.")
+                    self._state_dirty = True
+                    logger.info("  💾 State updated.")
                 else:
-                    prev_state['abs_ts'] = abs_progress
-                    prev_state['kosync_pct'] = kosync_progress
-                    prev_state['last_updated'] = time.time()
+                    prev_state.abs_ts = abs_progress
+                    prev_state.kosync_pct = kosync_progress
+                    prev_state.last_updated = time.time()
                     self.state[abs_id] = prev_state
-                    self._save_state()
+                    self._state_dirty = True
                     logger.info("  🤷 State matched to avoid loop.")
             except Exception as e:
                 logger.error(f"   Error syncing {abs_title}: {e}")
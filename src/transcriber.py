@@ -1,17 +1,52 @@
+import bisect
+import functools
+import glob
 import json
 import logging
 import os
 import shutil
 import subprocess
-import gc
+from array import array
+from collections import OrderedDict
 from pathlib import Path
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from mutagen import File as MutagenFile, MutagenError
 import requests
 import ffmpeg
 import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=4096)
+def _probe_duration(path_str, mtime_ns, size):
+    """
+    Returns a file's duration in seconds. mutagen reads it from the container
+    headers in-process; ffprobe is only forked for files mutagen can't handle.
+    mtime/size are only part of the cache key, so a file that changes on disk
+    is probed again.
+    """
+    try:
+        audio = MutagenFile(path_str)
+        if audio is not None and audio.info and audio.info.length:
+            return float(audio.info.length)
+    except MutagenError as e:
+        logger.debug(f"mutagen could not read {path_str}, falling back to ffprobe: {e}")
+
+    cmd = [
+        'ffprobe', 
+        '-v', 'error', 
+        '-show_entries', 'format=duration', 
+        '-of', 'default=noprint_wrappers=1:nokey=1', 
+        path_str
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return float(result.stdout.strip())
+
+def _cached_duration(filepath):
+    stat = os.stat(filepath)
+    return _probe_duration(str(filepath), stat.st_mtime_ns, stat.st_size)
+
 class AudioTranscriber:
     def __init__(self, data_dir):
         self.data_dir = data_dir
@@ -20,35 +55,41 @@ class AudioTranscriber:
         self.cache_root = data_dir / "audio_cache"
         self.cache_root.mkdir(parents=True, exist_ok=True)
         self.model_size = "tiny" 
+        self.batch_size = int(os.getenv("WHISPER_BATCH_SIZE", 0))
+        # e.g. int8_bfloat16 on CPUs with AVX-512 BF16/VNNI; int8 works everywhere
+        self.compute_type = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+        self.cpu_threads = int(os.getenv("WHISPER_CPU_THREADS", 4))
+        # transcript path -> (mtime_ns, (starts, ends, texts, joined, offsets)), least recently used first
+        self._transcript_cache = OrderedDict()
+        self.max_cached_transcripts = max(1, int(os.getenv("TRANSCRIPT_CACHE_MAX_BOOKS", 8)))
+        # (lookup, transcript path, query) -> result, least recently used first
+        self._lookup_cache = OrderedDict()
+
+    @functools.cached_property
+    def model(self):
+        """
+        Loaded on first use and reused for every job in a sweep of pending jobs,
+        instead of reloading weights and CTranslate2 thread pools per book.
+        """
+        logger.info(f"Loading Whisper {self.model_size} model ({self.compute_type}, {self.cpu_threads} threads)...")
+        return WhisperModel(self.model_size, device="cpu", compute_type=self.compute_type, cpu_threads=self.cpu_threads)
+
+    def unload_model(self):
+        """Drops the cached model so its memory is released while the daemon is idle."""
+        self.__dict__.pop('model', None)
 
     def _get_audio_duration(self, filepath):
         try:
-            cmd = [
-                "ffprobe", 
-                "-v", "error", 
-                "-show_entries", "format=duration", 
-                "-of", "default=noprint_wrappers=1:nokey=1", 
-                str(filepath)
-            ]
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            return float(result.stdout.strip())
+            return _cached_duration(filepath)
         except Exception as e:
             logger.error(f"Failed to get duration for {filepath}: {e}")
             return 0.0
 
     def get_audio_duration(self, file_path):
         """Returns the duration of the audio file in seconds using ffprobe."""
-        cmd = [
-            'ffprobe', 
-            '-v', 'error', 
-            '-show_entries', 'format=duration', 
-            '-of', 'default=noprint_wrappers=1:nokey=1', 
-            str(file_path)
-        ]
         try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            return float(result.stdout.strip())
-        except (ValueError, subprocess.CalledProcessError):
+            return _cached_duration(file_path)
+        except (ValueError, OSError, subprocess.CalledProcessError):
             logger.error(f"Could not determine duration for {file_path}")
             return 0.0
 
@@ -72,34 +113,30 @@ class AudioTranscriber:
         # Calculate the exact duration for each even chunk
         segment_duration = duration / num_parts
         
-        new_files = []
         base_name = file_path.stem
         extension = file_path.suffix
 
-        for i in range(num_parts):
-            start_time = i * segment_duration
-            new_filename = f"{base_name}_split_{i+1:03d}{extension}"
-            new_path = file_path.parent / new_filename
-            
-            # FFmpeg command to slice audio
-            # -ss : Start time
-            # -t  : Duration of the clip
-            # -c copy : Stream copy (FAST, no re-encoding, low RAM)
-            # Note: If precise cutting is required and -c copy is inaccurate, 
-            # remove '-c', 'copy' to re-encode (slower but precise).
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(file_path),
-                '-ss', str(start_time),
-                '-t', str(segment_duration),
-                '-c', 'copy',  
-                '-loglevel', 'error',
-                str(new_path)
-            ]
-            
-            subprocess.run(cmd, check=True)
-            new_files.append(new_path)
-            logger.info(f"  Created chunk {i+1}/{num_parts}: {new_filename} ({segment_duration/60:.2f}m)")
+        # FFmpeg segment muxer: one pass over the input writes every chunk
+        # -segment_time : Target duration of each chunk
+        # -c copy : Stream copy (FAST, no re-encoding, low RAM)
+        # -reset_timestamps 1 : Each chunk starts at 0 so per-part offsets stay correct
+        # Note: with -c copy, cuts land on the nearest packet boundary after each target time.
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', str(file_path),
+            '-f', 'segment',
+            '-segment_time', str(segment_duration),
+            '-segment_start_number', '1',
+            '-reset_timestamps', '1',
+            '-c', 'copy',
+            '-loglevel', 'error',
+            str(file_path.parent / f"{base_name}_split_%03d{extension}")
+        ]
+
+        subprocess.run(cmd, check=True)
+        new_files = sorted(file_path.parent.glob(f"{glob.escape(base_name)}_split_[0-9][0-9][0-9]{glob.escape(extension)}"))
+        for i, new_path in enumerate(new_files):
+            logger.info(f"  Created chunk {i+1}/{len(new_files)}: {new_path.name}")
 
         # Delete the original large file to save disk space
         file_path.unlink() 
@@ -125,44 +162,63 @@ class AudioTranscriber:
         try:
             # --- PHASE 1: DOWNLOAD ---
             logger.info(f"📥 Phase 1: Caching {len(audio_urls)} audio parts locally for {abs_id}...")
-            
-            for idx, audio_data in enumerate(audio_urls):
+
+            session = requests.Session()
+
+            def _fetch(idx, audio_data):
                 stream_url = audio_data['stream_url']
                 extension = audio_data.get('ext', '.mp3')
                 local_filename_old = f"part_{idx:03d}.mp3"
                 local_filename = f"part_{idx:03d}{extension}"
                 logger.debug(f"NEW {local_filename} -- {local_filename_old}")
                 local_path = book_cache_dir / local_filename
-                
+
                 logger.info(f"   Downloading Part {idx + 1}/{len(audio_urls)}...")
 
                 try:
-                    with requests.get(stream_url, stream=True, timeout=120) as r:
+                    with session.get(stream_url, stream=True, timeout=120) as r:
                         r.raise_for_status()
+                        # Copy straight from the socket in 1 MiB blocks instead of 8 KiB iter_content chunks
+                        r.raw.decode_content = True
                         with open(local_path, 'wb') as f:
-                            for chunk in r.iter_content(chunk_size=8192):
-                                f.write(chunk)
-                    
+                            shutil.copyfileobj(r.raw, f, length=1 << 20)
+
                     if not local_path.exists() or local_path.stat().st_size == 0:
                         raise ValueError(f"File {local_path} is empty or missing.")
 
                     # --- PHASE 1.5: Identify if audio exceeds 45min limit and chunk if necessary ---
-                    # Check length and split if necessary before appending
-                    final_parts = self.split_audio_file(local_path, MAX_DURATION_SECONDS)
-                    
-                    downloaded_files.extend(final_parts)
-                    
+                    # Check length and split if necessary before returning
+                    return self.split_audio_file(local_path, MAX_DURATION_SECONDS)
+
                 except Exception as e:
                     logger.error(f"❌ Failed to download Part {idx + 1}: {e}")
                     raise e
 
+            # Parts download concurrently; results are collected in the original part order
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, min(8, len(audio_urls)))) as executor:
+                    futures = [executor.submit(_fetch, idx, audio_data) for idx, audio_data in enumerate(audio_urls)]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except Exception:
+                        # Don't start the queued parts once any part has failed
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise
+                    for future in futures:
+                        downloaded_files.extend(future.result())
+            finally:
+                session.close()
+
             logger.info(f"✅ All parts cached. Starting AI processing...")
 
             # --- PHASE 2: TRANSCRIBE ---
             logger.info(f"🧠 Phase 2: Transcribing using {self.model_size} model...")
             
-            # Optimization: cpu_threads set explicitly, compute_type int8
-            model = WhisperModel(self.model_size, device="cpu", compute_type="int8", cpu_threads=4)
+            model = self.model
+            # Optional: batch the VAD-split windows of each part through the model together.
+            # Faster, but holds batch_size windows in memory at once, so it is opt-in.
+            pipeline = BatchedInferencePipeline(model=model) if self.batch_size > 1 else None
             full_transcript = []
             cumulative_duration = 0.0
 
@@ -171,7 +227,14 @@ class AudioTranscriber:
                 logger.info(f"   Transcribing Part {idx + 1}/{len(downloaded_files)} (Length: {duration:.2f}s)...")
                 
                 # CRITICAL FIX: beam_size=1 (Greedy Search) prevents OOM on long files
-                segments, info = model.transcribe(str(local_path), beam_size=1, best_of=1)
+                if pipeline:
+                    segments, info = pipeline.transcribe(
+                        str(local_path), batch_size=self.batch_size, beam_size=1, best_of=1,
+                        # Keep sentence-level segments; the batched default is one segment per VAD chunk
+                        without_timestamps=False
+                    )
+                else:
+                    segments, info = model.transcribe(str(local_path), beam_size=1, best_of=1)
                 
                 for segment in segments:
                     full_transcript.append({
@@ -181,9 +244,6 @@ class AudioTranscriber:
                     })
                 
                 cumulative_duration += duration
-                
-                # Optimization: Force garbage collection after each part
-                gc.collect()
 
             # --- PHASE 3: SAVE ---
             with open(output_file, 'w') as f:
@@ -203,68 +263,143 @@ class AudioTranscriber:
                 logger.info("🧹 Cleaning up audio cache...")
                 shutil.rmtree(book_cache_dir)
 
+    def _load_transcript(self, transcript_path):
+        """
+        Returns (starts, ends, texts, joined, offsets) for a transcript, re-reading the
+        JSON only when the file changed. The segments are held as parallel arrays
+        (struct-of-arrays) rather than a list of dicts: starts/ends are packed float
+        arrays. joined is every text separated by newlines, and offsets[i] is where
+        texts[i] begins inside it.
+        """
+        mtime = os.stat(transcript_path).st_mtime_ns
+        cached = self._transcript_cache.get(str(transcript_path))
+        if cached and cached[0] == mtime:
+            self._transcript_cache.move_to_end(str(transcript_path))
+            return cached[1]
+
+        with open(transcript_path, 'r') as f:
+            data = json.load(f)
+        texts = [seg['text'] for seg in data]
+        offsets = array('q')
+        position = 0
+        for text in texts:
+            offsets.append(position)
+            position += len(text) + 1
+        transcript = (
+            array('d', (seg['start'] for seg in data)),
+            array('d', (seg['end'] for seg in data)),
+            texts,
+            "\n".join(texts),
+            offsets
+        )
+        self._transcript_cache[str(transcript_path)] = (mtime, transcript)
+        self._transcript_cache.move_to_end(str(transcript_path))
+        while len(self._transcript_cache) > self.max_cached_transcripts:
+            self._transcript_cache.popitem(last=False)
+        # Memoized lookups may refer to the old contents
+        self._lookup_cache.clear()
+        return transcript
+
+    def _find_segment_index(self, starts, ends, timestamp):
+        """
+        Index of the segment containing timestamp, or else the closest one.
+        Segments are in time order, so a bisect on the start times replaces a linear scan.
+        """
+        if not starts: return -1
+
+        idx = bisect.bisect_right(starts, timestamp) - 1
+        if idx >= 0 and ends[idx] >= timestamp:
+            # Prefer the earliest segment when timestamp sits exactly on a boundary
+            while idx > 0 and ends[idx - 1] >= timestamp:
+                idx -= 1
+            return idx
+
+        # Falls in a gap (or before the first / after the last segment): pick the nearest edge
+        candidates = [i for i in (idx, idx + 1) if 0 <= i < len(starts)]
+        best = min(candidates, key=lambda i: min(abs(timestamp - starts[i]), abs(timestamp - ends[i])))
+        # Zero-length segments can share an end time; the earliest one wins, as before
+        if best == idx:
+            while best > 0 and ends[best - 1] == ends[idx]:
+                best -= 1
+        return best
+
+    def _memoized(self, key, compute):
+        """
+        Small LRU for text/time lookups. sync_cycle asks the same question again while
+        a position hasn't moved, so repeated queries skip the search entirely.
+        """
+        if key in self._lookup_cache:
+            self._lookup_cache.move_to_end(key)
+            return self._lookup_cache[key]
+
+        value = compute()
+        self._lookup_cache[key] = value
+        if len(self._lookup_cache) > 512:
+            self._lookup_cache.popitem(last=False)
+        return value
+
     def get_text_at_time(self, transcript_path, timestamp):
         try:
-            with open(transcript_path, 'r') as f:
-                data = json.load(f)
-
-            target_idx = -1
-            for i, seg in enumerate(data):
-                if seg['start'] <= timestamp <= seg['end']:
-                    target_idx = i
-                    break
-            
-            if target_idx == -1:
-                closest_dist = float('inf')
-                for i, seg in enumerate(data):
-                    dist = min(abs(timestamp - seg['start']), abs(timestamp - seg['end']))
-                    if dist < closest_dist:
-                        closest_dist = dist
-                        target_idx = i
-
-            if target_idx == -1: return None
-
-            TARGET_LEN = 400
-            segments_indices = [target_idx]
-            current_len = len(data[target_idx]['text'])
-            left = target_idx - 1
-            right = target_idx + 1
-            
-            while current_len < TARGET_LEN:
-                added = False
-                if left >= 0:
-                    segments_indices.insert(0, left)
-                    current_len += len(data[left]['text'])
-                    left -= 1
-                    added = True
-                if current_len >= TARGET_LEN: break
-                if right < len(data):
-                    segments_indices.append(right)
-                    current_len += len(data[right]['text'])
-                    right += 1
-                    added = True
-                if not added: break
-
-            return " ".join([data[i]['text'] for i in segments_indices])
-
+            transcript = self._load_transcript(transcript_path)
+            key = ("text_at_time", str(transcript_path), round(timestamp, 1))
+            return self._memoized(key, lambda: self._text_at_time(*transcript, timestamp))
         except Exception as e:
             logger.error(f"Error reading transcript {transcript_path}: {e}")
         
         return None
 
+    def _text_at_time(self, starts, ends, texts, joined, offsets, timestamp):
+        target_idx = self._find_segment_index(starts, ends, timestamp)
+
+        if target_idx == -1: return None
+
+        # Grow a contiguous window [left, right) around the target until it holds enough text
+        TARGET_LEN = 400
+        current_len = len(texts[target_idx])
+        left = target_idx
+        right = target_idx + 1
+        
+        while current_len < TARGET_LEN:
+            added = False
+            if left > 0:
+                left -= 1
+                current_len += len(texts[left])
+                added = True
+            if current_len >= TARGET_LEN: break
+            if right < len(texts):
+                current_len += len(texts[right])
+                right += 1
+                added = True
+            if not added: break
+
+        return " ".join(texts[left:right])
+
     def find_time_for_text(self, transcript_path, search_text):
-        from rapidfuzz import process, fuzz
         try:
-            with open(transcript_path, 'r') as f:
-                data = json.load(f)
-            
-            texts = [d['text'] for d in data]
-            match = process.extractOne(search_text, texts, scorer=fuzz.partial_ratio)
-            
-            if match and match[1] > 80:
-                index = match[2]
-                return data[index]['start']
+            transcript = self._load_transcript(transcript_path)
+            # Queries that start with the same text (ignoring case/whitespace) share an entry
+            query_prefix = " ".join(search_text.lower().split())[:64]
+            key = ("time_for_text", str(transcript_path), query_prefix)
+            return self._memoized(key, lambda: self._time_for_text(*transcript, search_text))
         except Exception as e:
             logger.error(f"Error searching transcript {transcript_path}: {e}")
         
         return None
+
+    def _time_for_text(self, starts, ends, texts, joined, offsets, search_text):
+        from rapidfuzz import process, fuzz
+
+        # Fast path: the leading text often occurs verbatim, and str.find is far cheaper than fuzzy scoring
+        probe = search_text[:80]
+        if probe:
+            position = joined.find(probe)
+            if position != -1:
+                return starts[bisect.bisect_right(offsets, position) - 1]
+
+        # score_cutoff lets RapidFuzz skip candidates early instead of scoring every segment fully
+        match = process.extractOne(search_text, texts, scorer=fuzz.partial_ratio, processor=None, score_cutoff=80)
+        
+        if match:
+            index = match[2]
+            return starts[index]
+        return None